@@ -122,7 +122,14 @@ def get_automap_session(
         dbkwargs = {k: auth.get(f'db-{k}') for k in ('user', 'host', 'port', 'database')}
         dbkwargs['dbuser'] = dbkwargs.pop('user')
 
-    engine = create_engine(dbUri(**dbkwargs))
+    engine = create_engine(
+        dbUri(**dbkwargs),
+        # same executemany settings as ingest.get_engine so session.add_all
+        # flushes and executemany inserts are batched instead of row by row
+        executemany_mode='values_plus_batch',
+        insertmanyvalues_page_size=1000,
+        executemany_batch_page_size=500,
+    )
     engine.echo = echo
 
     Base, models = reflect_models(engine, schema)
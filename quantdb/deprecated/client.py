@@ -36,7 +36,12 @@ def get_session(echo: bool = True, test: bool = False) -> Session:
         dbkwargs = {k: auth.get(f'db-{k}') for k in ('user', 'host', 'port', 'database')}
         dbkwargs['dbuser'] = dbkwargs.pop('user')
     print(dbkwargs)
-    engine = create_engine(dbUri(**dbkwargs))  # type: ignore
+    engine = create_engine(
+        dbUri(**dbkwargs),
+        executemany_mode='values_plus_batch',
+        insertmanyvalues_page_size=1000,
+        executemany_batch_page_size=500,
+    )  # type: ignore
     engine.echo = echo
     print(engine, dbkwargs)
     session = Session(engine)
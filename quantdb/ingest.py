@@ -1,10 +1,20 @@
+import csv
+import io
 import json
+import logging
+import os
 import pathlib
+import shutil
 import sys
 from collections import Counter, defaultdict
-from itertools import chain
+from concurrent.futures import ThreadPoolExecutor
+from functools import lru_cache
+from itertools import chain, cycle, repeat
 
 import idlib
+import ijson
+import numpy as np
+import orjson
 import requests
 from dateutil import parser as dateparser
 from pyontutils.utils_fast import chunk_list
@@ -17,8 +27,10 @@ from sparcur.utils import PennsieveId as RemoteId
 from sparcur.utils import fromJson
 from sparcur.utils import log as _slog
 from sparcur.utils import register_type
-from sqlalchemy import create_engine
+from sqlalchemy import Text, cast, column, create_engine, event, insert, table
+from sqlalchemy.dialects import postgresql
 from sqlalchemy.dialects.postgresql import JSONB
+from sqlalchemy.dialects.postgresql import insert as pg_insert
 from sqlalchemy.orm import Session
 from sqlalchemy.sql import bindparam
 from sqlalchemy.sql import text as sql_text
@@ -212,29 +224,50 @@ class getName:
     class MyBool:
         """python is dumb"""
 
+    _scalar_types = frozenset((str, int, float, type(None)))
+
     def __init__(self):
         self.counter = -1
         self.value_to_name = {}
+        # containers are keyed by id so each distinct object is only
+        # traversed once, _refs keeps them alive so ids are not reused
+        self._deep = {}
+        self._refs = []
 
     def valueCheck(self, value):
-        if isinstance(value, dict):
-            value = hash(
-                frozenset(
-                    (k, self.valueCheck(v) if isinstance(v, list) or isinstance(v, dict) else v)
-                    for k, v in value.items()
+        if value.__class__ in self._scalar_types:
+            return value
+
+        if isinstance(value, (dict, list)):
+            key = id(value)
+            c = self._deep.get(key)
+            if c is not None:
+                return c
+
+            if isinstance(value, dict):
+                c = hash(
+                    frozenset(
+                        (k, self.valueCheck(v) if isinstance(v, list) or isinstance(v, dict) else v)
+                        for k, v in value.items()
+                    )
                 )
-            )
-        elif isinstance(value, list):
-            value = tuple(self.valueCheck(e) for e in value)
+            else:
+                c = tuple(self.valueCheck(e) for e in value)
+
+            self._deep[key] = c
+            self._refs.append(value)
+            return c
         elif isinstance(value, bool):
             value = self.MyBool, value
-        else:
-            pass
 
         return value
 
     def __call__(self, value, type=None):
-        value = self.valueCheck(value)
+        # flat rows of scalars are the common case, only call into
+        # valueCheck for containers and bools
+        if value.__class__ not in self._scalar_types:
+            value = self.valueCheck(value)
+
         if type is not None and (value, type) in self.value_to_name:
             return self.value_to_name[value, type]
         elif type is None and value in self.value_to_name:
@@ -286,6 +319,7 @@ def makeParamsValues(*value_sets, constants=tuple(), types=tuple(), row_types=tu
                 for name, value, type in zip(names, values, row_types):
                     params[name] = value
                     if type is not None and name not in _done:
+                        _done.add(name)
                         bindparams.append(bindparam(name, type_=type))
         else:
             for names, values in proto_params:
@@ -326,9 +360,11 @@ seg_ordering = {
 }
 
 
+@lru_cache(maxsize=None)
 def anat_index(sample):
     # count the number of distinct values less than a given integer
     # create the map
+    # cached because ext_pmeta calls this once per file and files share samples
 
     if sample.count('-') < 3:
         sam, sam_id = sample.split('-')
@@ -344,17 +380,15 @@ def anat_index(sample):
     if seg_id is None:
         return sam_ind, 0, 0, 0
 
-    for k, v in seg_ordering.items():
-        if seg_id.startswith(k):
-            prefix = k
-            seg_ind = v
-            break
-    else:
+    # seg_ordering keys are single characters so the prefix is one lookup
+    prefix = seg_id[:1]
+    seg_ind = seg_ordering.get(prefix)
+    if seg_ind is None:
         if sam_id == 'c':
             # print('c sample', sample)
             # rest = int(''.join(_ for _ in seg_id if _.isdigit()))
             rest = int(seg_id[:-1])
-            suffix = int(seg_id[-1].encode().hex())
+            suffix = ord(seg_id[-1])
             return sam_ind, 0, rest, suffix
         else:
             msg = f'unknown seg {sample}'
@@ -371,19 +405,43 @@ def anat_index(sample):
 
 def proc_anat(rawind):
     # normalize the index by mapping distinct values to the integers
-    lin_distinct = {v: i for i, v in enumerate(sorted(set(rawind.values())))}
-    max_distinct = len(lin_distinct)
-    mdp1 = max_distinct + 0.1  # to simplify adding overlap
-    sindex = {}
-    for (d, s), raw in rawind.items():
-        # e['norm_anat_index'] = math.log10(e['raw_anat_index']) / log_max_rai
-        pos = lin_distinct[raw]
-        inst = (pos + 0.55) / mdp1
-        minp = pos / mdp1
-        maxp = (pos + 1.1) / mdp1  # ensure there is overlap between section for purposes of testing
-        sindex[(d, s)] = inst, minp, maxp
-
-    return sindex
+    if not rawind:
+        return {}
+
+    # unique rows sort lexicographically the same way sorted(set(...)) sorts the tuples
+    distinct, pos = np.unique(np.array(list(rawind.values())), axis=0, return_inverse=True)
+    pos = pos.reshape(-1)
+    mdp1 = len(distinct) + 0.1  # to simplify adding overlap
+    # e['norm_anat_index'] = math.log10(e['raw_anat_index']) / log_max_rai
+    inst = (pos + 0.55) / mdp1
+    minp = pos / mdp1
+    maxp = (pos + 1.1) / mdp1  # ensure there is overlap between section for purposes of testing
+    # tolist so downstream gets python floats not numpy scalars
+    return dict(zip(rawind, zip(inst.tolist(), minp.tolist(), maxp.tolist())))
+
+
+def _render_plot(plot_data):
+    # rendering stays synchronous in extract_reva_ft, which ingest_reva_ft_all
+    # runs in its extract pool so the plot is not on the insert path, errors
+    # propagate through the extract future
+    # the figure and canvas are built directly so there is no pyplot, no
+    # global backend switch, and no shared current figure to clobber
+    from matplotlib.backends.backend_agg import FigureCanvasAgg
+    from matplotlib.figure import Figure
+
+    x = plot_data['x']
+    sid = plot_data['sid']
+    fig = Figure()
+    FigureCanvasAgg(fig)
+    ax = fig.add_subplot()
+    ax.scatter(x, plot_data['ny'], label='inst')
+    ax.scatter(x, plot_data['nyn'], label='min')
+    ax.scatter(x, plot_data['nyx'], label='max')
+    ax.set_title(f'norm-anat-index-v2 for {sid}')
+    ax.set_xlabel('nth sample')
+    ax.set_ylabel('normalized anatomical index v2')
+    ax.legend(loc='upper left')
+    fig.savefig(f'ft-norm-anat-index-v2-{sid}.png')
 
 
 _translate_species = {}
@@ -531,8 +589,10 @@ def ext_pmeta(j, dataset_metadata=None, _pps=pps):
     out['file_id'] = (
         j['file_id'] if 'file_id' in j else int(j['uri_api'].rsplit('/')[-1])
     )  # XXX old pathmeta schema that didn't include file id
-    ps = pathlib.Path(j['dataset_relative_path']).parts
-    [p for p in ps if p.startswith('sub-') or p.startswith('sam-')]
+    drp = j['dataset_relative_path']
+    # raw path metadata paths are always posix relative strings so a split is
+    # enough, paths that came through fromJson already have their parts
+    ps = tuple(drp.split('/')) if isinstance(drp, str) else drp.parts
     out.update(_pps(ps, dataset_metadata))
     return out
 
@@ -541,92 +601,106 @@ def ext_pmeta123(j):
     return ext_pmeta(j, _pps=pps123)
 
 
+def _session_ids(session):
+    """lookup cache kept on the session, ids found in a transaction that
+    is rolled back may not exist afterward so a rollback empties it"""
+    cache = session.info.get('quantdb_ids')
+    if cache is None:
+        cache = session.info['quantdb_ids'] = {}
+        event.listen(session, 'after_soft_rollback', lambda s, previous_transaction: cache.clear())
+
+    return cache
+
+
 class Queries:
+    # built once so repeated lookups hit the compiled cache directly
+    _sql_addr = sql_text('select * from address_from_fadd_type_fadd(:fadd_type, :fadd)')
+    _sql_desc_inst = sql_text('select * from desc_inst_from_label(:label)')
+    _sql_desc_quant = sql_text('select * from desc_quant_from_label(:label)')
+    _sql_desc_cat = sql_text('select * from desc_cat_from_label_domain_label(:label, :domain_label)')
+    _sql_cterm = sql_text('select * from cterm_from_label(:label)')
+    # dataset is cast to text server side since luinst is keyed on the uuid string
+    _sql_insts = sql_text('select id, dataset::text, id_formal from insts_from_dataset(:dataset)')
+    _sql_insts_ids = sql_text('select id, dataset::text, id_formal from insts_from_dataset_ids(:dataset, :ids)')
+    _sql_prefetch = sql_text(
+        "select 'id', label, null, id from descriptors_inst "
+        "union all select 'qd', label, null, id from descriptors_quant "
+        "union all select 'ct', label, null, id from controlled_terms "
+        "union all select 'cd', label, null, min(id) from descriptors_cat group by label having count(*) = 1 "
+        "union all select 'addr', addr_type::text, addr_field, min(id) from addresses "
+        'group by addr_type, addr_field having count(*) = 1'
+    )
+
     def __init__(self, session):
         self.session = session
+        self._cache = _session_ids(session)
         self._inv = {}
 
-    def address_from_fadd_type_fadd(self, fadd_type, fadd):
+    def _scalar(self, inv_type, sql, params):
         # FIXME multi etc.
-        params = dict(fadd_type=fadd_type, fadd=fadd)
-        res = [
-            i
-            for i, in self.session.execute(
-                sql_text('select * from address_from_fadd_type_fadd(:fadd_type, :fadd)'), params
-            )
-        ]
-        if res:
-            out = res[0]
+        # the label lookups are read only and the ids never change once they
+        # exist so results are shared across all Queries on the same session
+        key = inv_type, tuple(params.items())
+        if key in self._cache:
+            out = self._cache[key]
+            self._inv[inv_type, out] = params
+            return out
+
+        # first() only fetches the row we use, a null result is still an error
+        row = self.session.execute(sql, params).first()
+        if row is not None:
+            out = row[0]
             if out is None:
                 raise ValueError(f'needed a result here {params}')
             else:
-                self._inv['addr', out] = params
+                self._cache[key] = out
+                self._inv[inv_type, out] = params
                 return out
 
+    def prefetch(self):
+        """fill the lookup cache for the whole database in a single query
+
+        labels and addresses that the lookup functions would resolve
+        unambiguously are loaded up front, anything else (e.g. a descriptor
+        label shared by several domains) still goes through its function
+        """
+        if 'prefetched' in self._cache:
+            return
+
+        keys = {
+            'id': lambda a, b: (('label', a),),
+            'qd': lambda a, b: (('label', a),),
+            'ct': lambda a, b: (('label', a),),
+            'cd': lambda a, b: (('label', a), ('domain_label', None)),
+            'addr': lambda a, b: (('fadd_type', a), ('fadd', b)),
+        }
+        for inv_type, a, b, out in self.session.execute(self._sql_prefetch):
+            self._cache[inv_type, keys[inv_type](a, b)] = out
+
+        self._cache['prefetched'] = True
+
+    def address_from_fadd_type_fadd(self, fadd_type, fadd):
+        return self._scalar('addr', self._sql_addr, dict(fadd_type=fadd_type, fadd=fadd))
+
     def desc_inst_from_label(self, label):
-        # FIXME multi etc.
-        params = dict(label=label)
-        res = [i for i, in self.session.execute(sql_text('select * from desc_inst_from_label(:label)'), params)]
-        if res:
-            out = res[0]
-            if out is None:
-                raise ValueError(f'needed a result here {params}')
-            else:
-                self._inv['id', out] = params
-                return out
+        return self._scalar('id', self._sql_desc_inst, dict(label=label))
 
     def desc_quant_from_label(self, label):
-        # FIXME multi etc.
-        params = dict(label=label)
-        res = [i for i, in self.session.execute(sql_text('select * from desc_quant_from_label(:label)'), params)]
-        if res:
-            out = res[0]
-            if out is None:
-                raise ValueError(f'needed a result here {params}')
-            else:
-                # kp = 'qdfi' if 'fiber' in label else 'qd'  # FIXME sigh XXX actually wasn't the issue i think?
-                # k = kp, out
-                self._inv['qd', out] = params
-                return out
+        # kp = 'qdfi' if 'fiber' in label else 'qd'  # FIXME sigh XXX actually wasn't the issue i think?
+        # k = kp, out
+        return self._scalar('qd', self._sql_desc_quant, dict(label=label))
 
     def desc_cat_from_label_domain_label(self, label, domain_label):
-        # FIXME multi etc.
-        params = dict(label=label, domain_label=domain_label)
-        res = [
-            i
-            for i, in self.session.execute(
-                sql_text('select * from desc_cat_from_label_domain_label(:label, :domain_label)'), params
-            )
-        ]
-        if res:
-            out = res[0]
-            if out is None:
-                raise ValueError(f'needed a result here {params}')
-            else:
-                self._inv['cd', out] = params
-                return out
+        return self._scalar('cd', self._sql_desc_cat, dict(label=label, domain_label=domain_label))
 
     def cterm_from_label(self, label):
-        # FIXME multi etc.
-        params = dict(label=label)
-        res = [i for i, in self.session.execute(sql_text('select * from cterm_from_label(:label)'), params)]
-        if res:
-            out = res[0]
-            if out is None:
-                raise ValueError(f'needed a result here {params}')
-            else:
-                self._inv['ct', out] = params
-                return out
+        return self._scalar('ct', self._sql_cterm, dict(label=label))
 
     def insts_from_dataset(self, dataset):
-        return list(self.session.execute(sql_text('select * from insts_from_dataset(:dataset)'), dict(dataset=dataset)))
+        return list(self.session.execute(self._sql_insts, dict(dataset=dataset)))
 
     def insts_from_dataset_ids(self, dataset, ids):
-        return list(
-            self.session.execute(
-                sql_text('select * from insts_from_dataset_ids(:dataset, :ids)'), dict(dataset=dataset, ids=ids)
-            )
-        )
+        return list(self.session.execute(self._sql_insts_ids, dict(dataset=dataset, ids=ids)))
 
 
 class InternalIds:
@@ -655,6 +729,7 @@ class InternalIds:
         self._addrmap = {}
         q = queries
         self._q = queries
+        q.prefetch()  # one round trip instead of one per lookup below
 
         self.addr_index = q.address_from_fadd_type_fadd('record-index', None)
 
@@ -834,22 +909,209 @@ class InternalIds:
         }
 
 
+def dedupe_rows(rows, name):
+    # keeps first occurrence order, identical rows would only be rejected
+    # or duplicated by the insert anyway
+    out = list(dict.fromkeys(rows))
+    if len(out) != len(rows):
+        log.debug(f'dropped {len(rows) - len(out)} duplicate {name} rows')
+
+    return out
+
+
+def copy_rows(session, table, columns, rows, on_conflict_do_nothing=False, merge=True):
+    """bulk load rows with COPY FROM STDIN on the session connection
+
+    COPY has no ON CONFLICT so when that is needed rows are copied into a
+    temporary staging table and merged with a single INSERT ... SELECT,
+    with merge=False rows are left in the staging table so that rows from
+    many calls can be merged at once with merge_staged
+    """
+    if not rows:
+        return
+
+    buf = io.StringIO()
+    # NULL is written as \N so that empty strings survive the round trip
+    csv.writer(buf).writerows(tuple('\\N' if v is None else v for v in row) for row in rows)
+    buf.seek(0)
+
+    cols = ', '.join(columns)
+    copy_opts = "(FORMAT csv, NULL '\\N')"
+    cursor = session.connection().connection.cursor()
+    try:
+        if on_conflict_do_nothing or not merge:
+            stage = f'copy_stage_{table}'
+            # temp tables are not wal logged, and AS SELECT only copies the
+            # column types, not not null etc. constraints
+            cursor.execute(f'CREATE TEMP TABLE IF NOT EXISTS {stage} AS SELECT {cols} FROM {table} WITH NO DATA')
+            cursor.copy_expert(f'COPY {stage} ({cols}) FROM STDIN WITH {copy_opts}', buf)
+            if merge:
+                cursor.execute(f'INSERT INTO {table} ({cols}) SELECT {cols} FROM {stage} ON CONFLICT DO NOTHING')
+                cursor.execute(f'DROP TABLE {stage}')
+        else:
+            cursor.copy_expert(f'COPY {table} ({cols}) FROM STDIN WITH {copy_opts}', buf)
+    finally:
+        cursor.close()
+
+
+def merge_staged(session, table, columns, on_conflict_do_nothing=False):
+    """merge rows left in staging by copy_rows(..., merge=False) in one statement"""
+    cols = ', '.join(columns)
+    stage = f'copy_stage_{table}'
+    ocdn = ' ON CONFLICT DO NOTHING' if on_conflict_do_nothing else ''
+    session.execute(sql_text(f'INSERT INTO {table} ({cols}) SELECT DISTINCT {cols} FROM {stage}{ocdn}'))
+    session.execute(sql_text(f'DROP TABLE {stage}'))
+
+
+def drop_indexes(session, tables):
+    """drop the non unique indexes on tables and return their definitions
+    so they can be recreated after a bulk load, unique indexes are kept
+    since ON CONFLICT needs them and indexes that back a constraint
+    (e.g. exclusion constraints) cannot be dropped on their own
+
+    DROP INDEX takes an ACCESS EXCLUSIVE lock on the table until commit
+    and the rebuild scans the whole table, so this is only for full reloads"""
+    rows = session.execute(
+        sql_text(
+            "SELECT format('%I.%I', n.nspname, c.relname), pg_get_indexdef(x.indexrelid) FROM pg_index AS x "
+            'JOIN pg_class AS c ON c.oid = x.indexrelid '
+            'JOIN pg_namespace AS n ON n.oid = c.relnamespace '
+            'JOIN pg_class AS t ON t.oid = x.indrelid '
+            'WHERE t.relname = ANY(:tables) AND t.relnamespace = current_schema()::regnamespace '
+            'AND NOT x.indisunique '
+            'AND NOT EXISTS (SELECT 1 FROM pg_constraint AS k WHERE k.conindid = x.indexrelid)'
+        ),
+        dict(tables=list(tables)),
+    ).all()
+    for name, _ in rows:
+        # name is already quoted by format %I
+        session.execute(sql_text(f'DROP INDEX {name}'))
+
+    return [index_def for _, index_def in rows]
+
+
 class Inserts:
-    # TODO
-    pass
+    # columns are listed in the order the make_* functions emit their row tuples
+    columns = {
+        'objects': ('id', 'id_type', 'id_file'),
+        'dataset_object': ('dataset', 'object'),
+        'values_inst': ('dataset', 'id_formal', 'type', 'desc_inst', 'id_sub', 'id_sam'),
+        'equiv_inst': ('left_thing', 'right_thing'),
+        'instance_parent': ('id', 'parent'),
+        'obj_desc_inst': ('object', 'desc_inst', 'addr_field', 'addr_desc_inst'),
+        'obj_desc_cat': ('object', 'desc_cat', 'addr_field'),
+        'obj_desc_quant': ('object', 'desc_quant', 'addr_field'),
+        'values_cat': ('value_open', 'value_controlled', 'object', 'desc_inst', 'desc_cat', 'instance'),
+        'values_quant': ('value', 'object', 'desc_inst', 'desc_quant', 'instance', 'value_blob'),
+    }
+    # these arrive already serialized to text and are cast server side
+    casts = {'value_blob': JSONB}
 
+    def __init__(self):
+        # tables that have rows waiting in staging, see merge
+        self.staged = set()
+        # statements are built once and reused for every dataset, the
+        # row count is no longer baked into the sql so executemany goes
+        # through the dialect insertmanyvalues batching
+        self.statements = {}
+        self.keys = {}
+        for name, cols in self.columns.items():
+            t = table(name, *(column(c) for c in cols))
+            values = {
+                c: cast(bindparam(f'{c}_text', type_=Text), type_) for c, type_ in self.casts.items() if c in cols
+            }
+            self.keys[name] = tuple(f'{c}_text' if c in values else c for c in cols)
+            self.statements[name] = insert(t).values(values), pg_insert(t).values(values).on_conflict_do_nothing()
 
-luinst = {}
+    def __call__(self, session, name, rows, dev=False, commit=False, batchsize=20000, use_copy=False, stage=False):
+        if stage:
+            # rows accumulate across calls until merge is called
+            copy_rows(session, name, self.columns[name], rows, merge=False)
+            if rows:
+                self.staged.add(name)
+
+            return
+
+        if use_copy:
+            copy_rows(session, name, self.columns[name], rows, on_conflict_do_nothing=dev)
+            if commit:
+                session.commit()
+
+            return
+
+        keys = self.keys[name]
+        stmt = self.statements[name][bool(dev)]
+        for chunk in chunk_list(rows, batchsize):
+            session.execute(stmt, [dict(zip(keys, row)) for row in chunk])
+            if commit:
+                session.commit()
+
+    def render(self, dev=False):
+        """sql for each table as it is sent for a single row, insertmanyvalues
+        repeats the VALUES clause of these once per page of rows"""
+        dialect = postgresql.dialect()
+        return {
+            name: str(stmts[bool(dev)].compile(dialect=dialect, column_keys=self.keys[name]))
+            for name, stmts in self.statements.items()
+        }
+
+    def merge(self, session, dev=False, commit=False):
+        # columns is in dependency order so merging in that order is safe
+        for name, cols in self.columns.items():
+            if name in self.staged:
+                merge_staged(session, name, cols, on_conflict_do_nothing=dev)
 
+        self.staged.clear()
+        if commit:
+            session.commit()
 
-def ingest(dataset_uuid, extract_fun, session, commit=False, dev=False, values_args=None, **kwargs):
+
+inserts = Inserts()
+
+
+luinst = {}
+
+# oh dear https://stackoverflow.com/questions/34708509/how-to-use-returning-with-on-conflict-in-postgresql
+# the dataset object, the objects_internal row, and the quantdb object
+# that points to it all go in one statement to save two round trips,
+# data modifying ctes always run even though d and q are not selected from
+_sql_ingest_dataset_updated = sql_text(
+    "WITH d AS (INSERT INTO objects (id, id_type) VALUES (:dataset, 'dataset') ON CONFLICT DO NOTHING), "
+    'ins AS (INSERT INTO objects_internal (type, dataset, updated_transitive, label) '
+    "VALUES ('path-metadata', :dataset, :updated_transitive, :label) ON CONFLICT DO NOTHING RETURNING id), "
+    'got AS (SELECT id FROM ins UNION ALL SELECT id FROM objects_internal '
+    "WHERE type = 'path-metadata' AND dataset = :dataset AND updated_transitive = :updated_transitive), "
+    # FIXME bad ocdn here
+    "q AS (INSERT INTO objects (id, id_type, id_internal) SELECT id, 'quantdb', id FROM got ON CONFLICT DO NOTHING) "
+    'SELECT id FROM got'
+)  # TODO see whether we actually need union all here or whether union by itself is sufficient
+_sql_ingest_dataset = sql_text('INSERT INTO objects (id, id_type) VALUES (:id, :id_type) ON CONFLICT DO NOTHING')
+
+
+def ingest(
+    dataset_uuid,
+    extract_fun,
+    session,
+    commit=False,
+    dev=False,
+    values_args=None,
+    use_copy=False,
+    stage=False,
+    chunk_size=20000,
+    inserts=inserts,
+    **kwargs,
+):
     """generic ingest workflow
     this_dataset_updated_uuid might not be needed in future,
     add a kwarg to control it maybe?
+    chunk_size is the number of rows per INSERT executemany, COPY is not chunked
+    use_copy loads the rows with COPY instead of INSERT, see copy_rows
+    stage leaves the rows that depend on instances in staging tables,
+    the caller must pass its own Inserts as inserts and run its merge
+    once all datasets are staged
+    commit happens once at the end so a dataset is loaded all or nothing
     """
 
-    ocdn = ' ON CONFLICT DO NOTHING' if dev else ''
-
     if extract_fun is None and values_args is None:
         raise TypeError('need one of extract_fun or values_args')
 
@@ -875,17 +1137,9 @@ def ingest(dataset_uuid, extract_fun, session, commit=False, dev=False, values_a
     # no dependencies to generate, but insert has to come after the dataset has been inserted (minimally)
     values_instances = make_values_instances(i)
 
-    res0 = session.execute(
-        sql_text('INSERT INTO objects (id, id_type) VALUES (:id, :id_type) ON CONFLICT DO NOTHING'),
-        dict(id=dataset_uuid, id_type='dataset'),
-    )
-
-    # oh dear https://stackoverflow.com/questions/34708509/how-to-use-returning-with-on-conflict-in-postgresql
     if updated_transitive:
         res1 = session.execute(
-            sql_text(
-                "WITH ins AS (INSERT INTO objects_internal (type, dataset, updated_transitive, label) VALUES ('path-metadata', :dataset, :updated_transitive, :label) ON CONFLICT DO NOTHING RETURNING id) SELECT id FROM ins UNION ALL SELECT id FROM objects_internal WHERE type = 'path-metadata' AND dataset = :dataset AND updated_transitive = :updated_transitive"
-            ),  # TODO see whether we actually need union all here or whether union by itself is sufficient
+            _sql_ingest_dataset_updated,
             dict(
                 dataset=dataset_uuid,
                 updated_transitive=updated_transitive,
@@ -898,180 +1152,170 @@ def ingest(dataset_uuid, extract_fun, session, commit=False, dev=False, values_a
         # and leave it at that, prov can be chased down later if needed
         this_dataset_updated_uuid = [_ for _, in res1][0]
     else:
+        res0 = session.execute(_sql_ingest_dataset, dict(id=dataset_uuid, id_type='dataset'))
         this_dataset_updated_uuid = None
 
-    void = make_void(this_dataset_updated_uuid, i)
-    vocd = make_vocd(this_dataset_updated_uuid, i)
-    voqd = make_voqd(this_dataset_updated_uuid, i)
-
-    if updated_transitive:
-        res1_1 = session.execute(
-            sql_text(
-                'INSERT INTO objects (id, id_type, id_internal) VALUES (:id, :id_type, :id) ON CONFLICT DO NOTHING'
-            ),  # FIXME bad ocdn here
-            dict(id=this_dataset_updated_uuid, id_type='quantdb'),
-        )
-
-    batchsize = 20000
-    if values_objects:
-        for chunk in chunk_list(values_objects, batchsize):
-            vt, params = makeParamsValues(chunk)
-            session.execute(sql_text(f'INSERT INTO objects (id, id_type, id_file) VALUES {vt}{ocdn}'), params)
-            if commit:
-                session.commit()
-
-    if values_dataset_object:
-        for chunk in chunk_list(values_dataset_object, batchsize):
-            vt, params = makeParamsValues(chunk)
-            session.execute(sql_text(f'INSERT INTO dataset_object (dataset, object) VALUES {vt}{ocdn}'), params)
-            if commit:
-                session.commit()
+    void = dedupe_rows(make_void(this_dataset_updated_uuid, i), 'obj_desc_inst')
+    vocd = dedupe_rows(make_vocd(this_dataset_updated_uuid, i), 'obj_desc_cat')
+    voqd = dedupe_rows(make_voqd(this_dataset_updated_uuid, i), 'obj_desc_quant')
 
-    if values_instances:
-        for chunk in chunk_list(values_instances, batchsize):
-            vt, params = makeParamsValues(chunk)
-            session.execute(
-                sql_text(
-                    f'INSERT INTO values_inst (dataset, id_formal, type, desc_inst, id_sub, id_sam) VALUES {vt}{ocdn}'
-                ),
-                params,
-            )
-            if commit:
-                session.commit()
+    inserts(session, 'objects', values_objects, dev=dev, batchsize=chunk_size, use_copy=use_copy)
+    inserts(session, 'dataset_object', values_dataset_object, dev=dev, batchsize=chunk_size, use_copy=use_copy)
+    inserts(session, 'values_inst', values_instances, dev=dev, batchsize=chunk_size, use_copy=use_copy)
 
     # inserts that depend on instances having already been inserted
     # ilt = q.insts_from_dataset_ids(dataset_uuid, [f for d, f, *rest in values_instances])
     # get all instances in a dataset since values_inst only includes instances we plan to insert
     # not those that were already inserted that we want to add values for
     ilt = q.insts_from_dataset(dataset_uuid)
-    _luinst = {(str(dataset), id_formal): id for id, dataset, id_formal in ilt}
-    luinst.update(_luinst)
+    if ilt:
+        ids, datasets, id_formals = zip(*ilt)
+        luinst.update(zip(zip(datasets, id_formals), ids))
     equiv_inst = make_equiv_inst(i, luinst)
 
     values_parents = make_values_parents(luinst)
-    values_cv = make_values_cat(this_dataset_updated_uuid, i, luinst)
+    values_cv = dedupe_rows(make_values_cat(this_dataset_updated_uuid, i, luinst), 'values_cat')
     values_qv = make_values_quant(this_dataset_updated_uuid, i, luinst)
 
-    if equiv_inst:
-        for chunk in chunk_list(equiv_inst, batchsize):
-            vt, params = makeParamsValues(chunk)
-            session.execute(sql_text(f'INSERT INTO equiv_inst VALUES {vt}{ocdn}'), params)
-            if commit:
-                session.commit()
+    inserts(session, 'equiv_inst', equiv_inst, dev=dev, batchsize=chunk_size, use_copy=use_copy, stage=stage)
 
     if values_parents:
-        for chunk in chunk_list(values_parents, batchsize):
-            vt, params = makeParamsValues(chunk)
-            session.execute(sql_text(f'INSERT INTO instance_parent VALUES {vt}{ocdn}'), params)
-            if commit:
-                session.commit()
+        inserts(
+            session, 'instance_parent', values_parents, dev=dev, batchsize=chunk_size, use_copy=use_copy, stage=stage
+        )
     else:
         # this is ok if some other ingest provides these
         log.warning(f'no parents for {dataset_uuid}')
 
-    if void:
-        for chunk in chunk_list(void, batchsize):
-            vt, params = makeParamsValues(chunk)
-            session.execute(
-                sql_text(
-                    f'INSERT INTO obj_desc_inst (object, desc_inst, addr_field, addr_desc_inst) VALUES {vt}{ocdn}'
-                ),
-                params,
-            )
-            if commit:
-                session.commit()
-
-    if vocd:
-        for chunk in chunk_list(vocd, batchsize):
-            vt, params = makeParamsValues(chunk)
-            session.execute(
-                sql_text(f'INSERT INTO obj_desc_cat (object, desc_cat, addr_field) VALUES {vt}{ocdn}'), params
-            )
-            if commit:
-                session.commit()
-
-    if voqd:
-        for chunk in chunk_list(voqd, batchsize):
-            vt, params = makeParamsValues(chunk)
-            session.execute(
-                sql_text(f'INSERT INTO obj_desc_quant (object, desc_quant, addr_field) VALUES {vt}{ocdn}'), params
-            )
-            if commit:
-                session.commit()
-
-    if values_cv:
-        for chunk in chunk_list(values_cv, batchsize):
-            vt, params = makeParamsValues(chunk)
-            session.execute(
-                sql_text(
-                    f'INSERT INTO values_cat (value_open, value_controlled, object, desc_inst, desc_cat, instance) VALUES {vt}{ocdn}'
-                ),
-                params,
-            )
-            if commit:
-                session.commit()
+    inserts(session, 'obj_desc_inst', void, dev=dev, batchsize=chunk_size, use_copy=use_copy, stage=stage)
+    inserts(session, 'obj_desc_cat', vocd, dev=dev, batchsize=chunk_size, use_copy=use_copy, stage=stage)
+    inserts(session, 'obj_desc_quant', voqd, dev=dev, batchsize=chunk_size, use_copy=use_copy, stage=stage)
+    inserts(session, 'values_cat', values_cv, dev=dev, batchsize=chunk_size, use_copy=use_copy, stage=stage)
+    # value_blob is serialized here instead of per row in the driver adapter
+    values_qv = [(*r[:-1], orjson.dumps(r[-1], option=orjson.OPT_SERIALIZE_NUMPY).decode()) for r in values_qv]
+    values_qv = dedupe_rows(values_qv, 'values_quant')  # after serialization so blobs are hashable
+    inserts(session, 'values_quant', values_qv, dev=dev, batchsize=chunk_size, use_copy=use_copy, stage=stage)
+
+    if commit:
+        session.commit()
+
+
+# one pooled session for all the cassava fetches so that batch runs reuse
+# connections instead of paying for a new tls handshake per file, sized
+# for the extract thread pool in ingest_reva_ft_all
+_http = requests.Session()
+_http.mount('https://', requests.adapters.HTTPAdapter(pool_connections=4, pool_maxsize=8))
+
+
+def fetch_cached(url, cache_path, refresh=False):
+    """make sure cache_path holds the current copy of url and return it,
+    the copy is reused when the remote has not been modified since it was
+    written so that rerunning a failed ingest does not download everything
+    again, the body is streamed to disk so it is never held in memory"""
+    if not refresh and cache_path.exists():
+        last_modified = _http.head(url, allow_redirects=True).headers.get('Last-Modified')
+        if last_modified is not None and dateparser.parse(last_modified).timestamp() <= cache_path.stat().st_mtime:
+            return cache_path
+
+    cache_path.parent.mkdir(parents=True, exist_ok=True)
+    # write next to the cache and rename so a killed run never leaves a
+    # truncated file that looks newer than the remote
+    part = cache_path.with_name(cache_path.name + '.part')
+    with _http.get(url, stream=True) as resp:
+        resp.raise_for_status()
+        resp.raw.decode_content = True
+        with open(part, 'wb') as f:
+            shutil.copyfileobj(resp.raw, f)
+
+    os.replace(part, cache_path)
+    return cache_path
+
+
+def load_json_cached(url, cache_path, load):
+    """call load on the open cached copy of url, if the copy does not
+    decode it is fetched again once"""
+    try:
+        with open(fetch_cached(url, cache_path), 'rb') as f:
+            return load(f)
+    except (orjson.JSONDecodeError, ijson.JSONError) as e:
+        log.warning(f'refetching {url} since {cache_path} did not decode: {e}')
+        with open(fetch_cached(url, cache_path, refresh=True), 'rb') as f:
+            return load(f)
+
+
+def scan_path_metadata(records, mimetype='image/jpx'):
+    """single pass over path metadata records that keeps only the records of
+    mimetype and the most recent timestamp_updated so that the full path
+    metadata never has to be held in memory when records is a stream
+    timestamps are parsed before comparing since sparcur isoformat uses ,
+    for fractions and drops zero fractions so the strings do not sort"""
+    records = iter(records)
+    first = next(records)  # the dataset object itself
+    updated_transitive = None
+    keep = []
+    for j in records:
+        ts = dateparser.isoparse(j['timestamp_updated'])
+        if updated_transitive is None or ts > updated_transitive:
+            updated_transitive = ts
 
-    if values_qv:
-        for chunk in chunk_list(values_qv, batchsize):
-            vt, params, bindparams = makeParamsValues(
-                # FIXME LOL the types spec here is atrocious ... but it does work ...
-                # XXX and barring the unfortunate case, which we have now encountered  where
-                # now fixed in the local impl
-                chunk,
-                row_types=(None, None, None, None, None, JSONB),
-            )
+        if j.get('mimetype') == mimetype:
+            keep.append(j)
 
-            t = sql_text(
-                f'INSERT INTO values_quant (value, object, desc_inst, desc_quant, instance, value_blob) VALUES {vt}{ocdn}'
-            )
-            tin = t.bindparams(*bindparams)
-            session.execute(tin, params)
-            if commit:
-                session.commit()
+    return first, updated_transitive, keep
 
 
-def extract_reva_ft(dataset_uuid, source_local=False, visualize=False):
+def extract_reva_ft(dataset_uuid, source_local=False, visualize=False, cache=False):
     if source_local:
         with open(
             pathlib.Path(
                 f'~/.local/share/sparcur/export/datasets/{dataset_uuid}/LATEST/path-metadata.json'
             ).expanduser(),
-            'rt',
+            'rb',
         ) as f:
-            blob = json.load(f)
+            first, updated_transitive, jpx = scan_path_metadata(ijson.items(f, 'data.item', use_float=True))
 
         with open(
             pathlib.Path(
                 f'~/.local/share/sparcur/export/datasets/{dataset_uuid}/LATEST/curation-export.json'
             ).expanduser(),
-            'rt',
+            'rb',
         ) as f:
-            blob_dataset = json.load(f)
-    else:
-
-        resp_dataset = requests.get(
-            f'https://cassava.ucsd.edu/sparc/datasets/{dataset_uuid}/LATEST/curation-export.json'
+            blob_dataset = orjson.loads(f.read())
+    elif cache:
+        base = f'https://cassava.ucsd.edu/sparc/datasets/{dataset_uuid}/LATEST'
+        cache_dir = pathlib.Path(f'~/.cache/quantdb/reva-ft/{dataset_uuid}').expanduser()
+        blob_dataset = load_json_cached(
+            f'{base}/curation-export.json', cache_dir / 'curation-export.json', lambda f: orjson.loads(f.read())
+        )
+        # the cached path metadata is streamed just like the remote one below
+        first, updated_transitive, jpx = load_json_cached(
+            f'{base}/path-metadata.json',
+            cache_dir / 'path-metadata.json',
+            lambda f: scan_path_metadata(ijson.items(f, 'data.item', use_float=True)),
         )
-        blob_dataset = resp_dataset.json()
+    else:
 
-        resp = requests.get(f'https://cassava.ucsd.edu/sparc/datasets/{dataset_uuid}/LATEST/path-metadata.json')
+        resp_dataset = _http.get(f'https://cassava.ucsd.edu/sparc/datasets/{dataset_uuid}/LATEST/curation-export.json')
+        blob_dataset = orjson.loads(resp_dataset.content)
 
-        try:
-            blob = resp.json()
-        except Exception as e:
-            breakpoint()
-            raise e
+        resp = _http.get(
+            f'https://cassava.ucsd.edu/sparc/datasets/{dataset_uuid}/LATEST/path-metadata.json', stream=True
+        )
+        resp.raw.decode_content = True
+        first, updated_transitive, jpx = scan_path_metadata(ijson.items(resp.raw, 'data.item', use_float=True))
 
     ir_dataset = fromJson(blob_dataset)
 
-    for j in blob['data']:
-        j['type'] = 'pathmeta'
+    # only the jpx records are used so skip fromJson on the full path metadata
+    # and only convert the fields that ext_pmeta needs on the records we keep
+    dataset_ids = {}
+    for j in jpx:
+        did = j['dataset_id']
+        if did not in dataset_ids:
+            dataset_ids[did] = RemoteId(did)
 
-    ir = fromJson(blob)
-
-    updated_transitive = max([i['timestamp_updated'] for i in ir['data'][1:]])  # 1: to skip the dataset object itself
-
-    jpx = [r for r in ir['data'] if 'mimetype' in r and r['mimetype'] == 'image/jpx']
+        j['dataset_id'] = dataset_ids[did]
+        j['remote_id'] = RemoteId(j['remote_id'])
 
     exts = [ext_pmeta(j) for j in jpx]
 
@@ -1086,6 +1330,20 @@ def extract_reva_ft(dataset_uuid, source_local=False, visualize=False):
     ) = ext_values(exts, dataset_metadata=ir_dataset)
     parents = _parents  # yes this is empty
 
+    if visualize:
+        srs = [k for k, v in instances.items() if v['type'] == 'sample']
+        sindex = proc_anat({(d, s): anat_index(s) for d, s in srs})
+        # inst, min, and max are all increasing in the same rank so one sort orders all three
+        ny, nyn, nyx = zip(*sorted(sindex.values()))
+        plot_data = dict(
+            x=list(range(len(ny))),
+            ny=list(ny),
+            nyn=list(nyn),
+            nyx=list(nyx),
+            sid=first['basename'].split('-')[-1].strip(),
+        )
+        _render_plot(plot_data)  # synchronous, see _render_plot
+
     # hrm = sorted(exts, key=lambda j: j['raw_anat_index'])
     # max_rai  = max([e['raw_anat_index'] for e in exts])
     # import math
@@ -1098,7 +1356,6 @@ def extract_reva_ft(dataset_uuid, source_local=False, visualize=False):
     max_distinct = len(lin_distinct)
     mdp1 = max_distinct + 0.1  # to simplify adding overlap
 
-    dd = defaultdict(list)
     for e in exts:
         # e['norm_anat_index'] = math.log10(e['raw_anat_index']) / log_max_rai
         pos = lin_distinct[e['raw_anat_index_v2']]
@@ -1109,52 +1366,11 @@ def extract_reva_ft(dataset_uuid, source_local=False, visualize=False):
         ) / mdp1  # ensure there is overlap between section for purposes of testing
         # TODO norm_anat_index_min
         # TODO norm_anat_index_max
-        dd[e['dataset'], e['sample']].append(e)
-    inst_obj_index = dict(dd)
 
     max_nai = max([e['norm_anat_index_v2'] for e in exts])
     min_nain = min([e['norm_anat_index_v2_min'] for e in exts])
     max_naix = max([e['norm_anat_index_v2_max'] for e in exts])
 
-    if visualize:
-        mexts = []
-        done = set()
-        for e in exts:
-            if e['sample'] not in done:
-                mexts.append(e)
-                done.add(e['sample'])
-
-        _exts = exts
-        exts = mexts
-        x = list(range(len(exts)))
-        # ry = sorted([e['raw_anat_index'] for e in exts])
-        idy = [b for a, b in sorted([(e['norm_anat_index_v2'], e['sample']) for e in exts])]
-        ny = sorted([e['norm_anat_index_v2'] for e in exts])
-        nyn = sorted([e['norm_anat_index_v2_min'] for e in exts])
-        nyx = sorted([e['norm_anat_index_v2_max'] for e in exts])
-        nnx = list(zip(nyn, nyx))
-        import pylab as plt
-        import seaborn
-
-        # plt.figure()
-        # seaborn.scatterplot(x=x, y=ry)
-        plt.figure()
-        # end = 10
-        end = len(x)
-        seaborn.scatterplot(x=x[:end], y=ny[:end], label='inst')
-        seaborn.scatterplot(x=x[:end], y=nyn[:end], label='min')
-        seaborn.scatterplot(x=x[:end], y=nyx[:end], label='max')
-        _sid = blob['data'][0]['basename'].split('-')[-1].strip()
-        # if _sid == 'f003':
-        # breakpoint()
-        plt.title(f'norm-anat-index-v2 for {_sid}')
-        plt.xlabel('nth sample')
-        plt.ylabel('normalized anatomical index v2')
-        plt.legend(loc='upper left')
-        # plt.savefig(f'ft-norm-anat-index-v2-{dataset_uuid[:4]}.png')
-        plt.savefig(f'ft-norm-anat-index-v2-{_sid}.png')
-        exts = _exts
-
     datasets = {i.uuid: {'id_type': i.type} for e in exts if (i := e['dataset'])}
 
     packages = {
@@ -1225,6 +1441,9 @@ def extract_reva_ft(dataset_uuid, source_local=False, visualize=False):
         values_parents = [(luinst[d.uuid, child], luinst[d.uuid, parent]) for d, child, parent in parents]
         return values_parents
 
+    # shared by make_void and make_vocd so objects is only filtered once
+    package_ids = [o for o, b in objects.items() if b['id_type'] == 'package']
+
     # XXX REMINDER an object descriptor pair can be associated with an arbitrary number of measured instances
     # BUT that mapping only appears when there is _something_ in the qv or cv tables so we need an object
     # desc_inst pair, and an object cat or quant desc pair otherwise our constraints are violated
@@ -1243,16 +1462,10 @@ def extract_reva_ft(dataset_uuid, source_local=False, visualize=False):
             # XXX the other option would just be to just put the darned files in the instance measured table :/ because we do have data about them
             # annoying :/
             # + [(i, 'nerve-volume', addr_context) for i in packages]
-        ] + [
-            (
-                o,
-                i.id_nerve_volume,
-                i.addr_const_null,
-                None,
-            )  # XXX FIXME this is the only way I can think to do this right now ?
-            for o, b in objects.items()
-            if b['id_type'] == 'package'
         ]
+        id_nerve_volume, addr_const_null = i.id_nerve_volume, i.addr_const_null
+        # XXX FIXME this is the only way I can think to do this right now ?
+        void += [(o, id_nerve_volume, addr_const_null, None) for o in package_ids]
 
         return void
 
@@ -1261,11 +1474,10 @@ def extract_reva_ft(dataset_uuid, source_local=False, visualize=False):
             # FIXME this reveals that there are cases where we may not have void for a single file or that the id comes from context and is not embedded
             # figuring out how to turn that around is going to take a bit of thinking
             (this_dataset_updated_uuid, i.cd_mod, i.addr_jpmod),
-        ] + [
-            (o, i.cd_obj, i.addr_const_null)
-            for o, b in objects.items()
-            if b['id_type'] == 'package'  # XXX FIXME this is the only way I can think to do this right now ?
         ]
+        cd_obj, addr_const_null = i.cd_obj, i.addr_const_null
+        # XXX FIXME this is the only way I can think to do this right now ?
+        vocd += [(o, cd_obj, addr_const_null) for o in package_ids]
 
         return vocd
 
@@ -1284,49 +1496,50 @@ def extract_reva_ft(dataset_uuid, source_local=False, visualize=False):
 
     def make_values_cat(this_dataset_updated_uuid, i, luinst):
         # obj_index = {e['object']: e for e in exts}
-        values_cv = [
+        # one pass over exts, each ext gets a modality row and an object row
+        # that share the same instance lookup
+        luct, id_nerve_volume, cd_mod, cd_obj, ct_hack = i.luct, i.id_nerve_volume, i.cd_mod, i.cd_obj, i.ct_hack
+        values_cv = []
+        append = values_cv.append
+        # a sample has many jpx files so resolve each sample instance once
+        # instead of rebuilding the uuid key for every ext
+        sample_inst = {}
+        for e in exts:
             # value_open, value_controlled, object, desc_inst, desc_cat
-            (
-                e[k],
-                i.luct[e[k]],
-                this_dataset_updated_uuid,
-                # e['object'].uuid,  # FIXME still not right this comes from the updated latest
-                i.id_nerve_volume,
-                cd,  # if we mess this up the fk ok obj_desc_cat will catch it :)
-                luinst[e['dataset'].uuid, e['sample']],  # get us the instance
-            )
-            for e in exts
-            for k, cd in (('modality', i.cd_mod),)
-        ] + [
-            (
-                None,
-                i.ct_hack,
-                e['object'].uuid,
-                i.id_nerve_volume,
-                i.cd_obj,  # if we mess this up the fk ok obj_desc_cat will catch it :)
-                luinst[e['dataset'].uuid, e['sample']],  # get us the instance
+            sk = e['dataset'], e['sample']
+            inst = sample_inst.get(sk)
+            if inst is None:
+                inst = sample_inst[sk] = luinst[sk[0].uuid, sk[1]]  # get us the instance
+
+            mod = e['modality']
+            append(
+                (
+                    mod,
+                    luct[mod],
+                    this_dataset_updated_uuid,
+                    # e['object'].uuid,  # FIXME still not right this comes from the updated latest
+                    id_nerve_volume,
+                    cd_mod,  # if we mess this up the fk ok obj_desc_cat will catch it :)
+                    inst,
+                )
             )
-            for e in exts
-        ]
+            append((None, ct_hack, e['object'].uuid, id_nerve_volume, cd_obj, inst))
+
         return values_cv
 
     def make_values_quant(this_dataset_updated_uuid, i, luinst):
         srs = {k: v for k, v in instances.items() if v['type'] == 'sample'}
         rawind = {(d, s): anat_index(s) for (d, s), v in srs.items()}
         sindex = proc_anat(rawind)
-        values_qv = [
-            # value, object, desc_inst, desc_quant, inst, value_blob
-            (
-                v,
-                this_dataset_updated_uuid,
-                i.luid[srs[(d, s)]['desc_inst']],
-                qd,
-                luinst[d.uuid, s],
-                v,
-            )
-            for (d, s), (inst, minp, maxp) in sindex.items()
-            for v, qd in ((inst, i.qd_nai), (minp, i.qd_nain), (maxp, i.qd_naix))
-        ]
+        # build each column once and zip them into rows at the end, every
+        # sample contributes three values (inst, min, max) in qd order
+        nqd = 3
+        qds = i.qd_nai, i.qd_nain, i.qd_naix
+        values = list(chain.from_iterable(sindex.values()))
+        dis = [di for k in sindex for di in repeat(i.luid[srs[k]['desc_inst']], nqd)]
+        insts = [inst for d, s in sindex for inst in repeat(luinst[d.uuid, s], nqd)]
+        # value, object, desc_inst, desc_quant, inst, value_blob
+        values_qv = list(zip(values, repeat(this_dataset_updated_uuid), dis, cycle(qds), insts, values))
         return values_qv
 
     make_equiv_inst = lambda i, l: []
@@ -1349,26 +1562,37 @@ def extract_reva_ft(dataset_uuid, source_local=False, visualize=False):
 
 def values_objects_from_objects(objects):
     return [
-        (i, o['id_type'], o['id_file'] if 'id_file' in o else None)
-        for i, o in objects.items()
-        if o['id_type'] != 'dataset'
+        (i, o['id_type'], o.get('id_file')) for i, o in objects.items() if o['id_type'] != 'dataset'
     ]  # already did it above
 
 
 def ext_values(exts, ext_contents=None, dataset_metadata=None, process_record=None, tabular_header=True):
-    datasets = {i.uuid: {'id_type': i.type} for e in exts if (i := e['dataset'])}
-
-    packages = {
-        i.uuid: {
-            'id_type': i.type,
-            'id_file': e['file_id'],
-        }
-        for e in exts
-        if (i := e['object'])
-    }
+    # collect the keys for every table in a single pass over exts, dicts
+    # with None values are used as insertion ordered sets
+    datasets, packages, dataset_object = {}, {}, {}
+    subject_keys, sample_keys, site_keys, parents = {}, {}, {}, {}
+    luty, lutysi = {}, {}
+    for e in exts:
+        d, o, sub, sam, site = e['dataset'], e['object'], e['subject'], e['sample'], e['site']
+        if d:
+            datasets[d.uuid] = {'id_type': d.type}
+        if o:
+            packages[o.uuid] = {'id_type': o.type, 'id_file': e['file_id']}
+            if d:
+                dataset_object[d.uuid, o.uuid] = None
+
+        subject_keys[d, sub] = None
+        luty[sam] = e['sample_type']
+        sample_keys[d, sam, sub] = None
+        if site is not None:
+            lutysi[site] = e['site_type']
+            site_keys[d, site, sam, sub] = None
+
+        for p in e['parents']:
+            parents[(d, *p)] = None
 
     objects = {**datasets, **packages}
-    dataset_object = list(set((d.uuid, o.uuid) for e in exts if (d := e['dataset']) and (o := e['object'])))
+    dataset_object = list(dataset_object)
 
     subjects = {
         k: {
@@ -1376,11 +1600,11 @@ def ext_values(exts, ext_contents=None, dataset_metadata=None, process_record=No
             'desc_inst': 'human',  # FIXME hardcoded
             'id_sub': k[1],
         }
-        for k in sorted(set((e['dataset'], e['subject']) for e in exts))
+        for k in subject_keys
     }
-    parents = sorted(set((e['dataset'],) + p for e in exts for p in e['parents']))
+    # order is not needed here, callers that care (e.g. extract_fasc_fib) run sort_parents
+    parents = list(parents)
 
-    luty = {e['sample']: e['sample_type'] for e in exts}
     samples = {
         k[:2]: {
             'type': 'sample',
@@ -1388,10 +1612,9 @@ def ext_values(exts, ext_contents=None, dataset_metadata=None, process_record=No
             'id_sub': k[-1],
             'id_sam': k[1],
         }
-        for k in sorted(set((e['dataset'], e['sample'], e['subject']) for e in exts))
+        for k in sample_keys
     }
 
-    lutysi = {e['site']: e['site_type'] for e in exts if e['site'] is not None}
     sites = {
         k[:2]: {
             'type': 'site',
@@ -1399,9 +1622,7 @@ def ext_values(exts, ext_contents=None, dataset_metadata=None, process_record=No
             'id_sub': k[-1],
             'id_sam': k[-2],  # TODO backfill
         }
-        for k in sorted(
-            set((e['dataset'], e['site'], e['sample'], e['subject']) for e in exts if e['site'] is not None)
-        )
+        for k in site_keys
     }
 
     if dataset_metadata:
@@ -1505,22 +1726,16 @@ def ext_values(exts, ext_contents=None, dataset_metadata=None, process_record=No
 def extract_demo_jp2(dataset_uuid, source_local=False):
     # this is a 1.2.3 dataset so a bit different
 
-    resp = requests.get(f'https://cassava.ucsd.edu/sparc/datasets/{dataset_uuid}/LATEST/path-metadata.json')
-
-    try:
-        blob = resp.json()
-    except Exception as e:
-        breakpoint()
-        raise e
-
-    for j in blob['data']:
+    resp = _http.get(f'https://cassava.ucsd.edu/sparc/datasets/{dataset_uuid}/LATEST/path-metadata.json', stream=True)
+    resp.raw.decode_content = True
+    # stream the path metadata and only run fromJson on the jp2 records
+    _, updated_transitive, jp2 = scan_path_metadata(
+        ijson.items(resp.raw, 'data.item', use_float=True), mimetype='image/jp2'
+    )
+    for j in jp2:
         j['type'] = 'pathmeta'
 
-    ir = fromJson(blob)
-
-    updated_transitive = max([i['timestamp_updated'] for i in ir['data'][1:]])  # 1: to skip the dataset object itself
-
-    jp2 = [r for r in ir['data'] if 'mimetype' in r and r['mimetype'] == 'image/jp2']
+    jp2 = fromJson({'data': jp2})['data']
 
     exts = [ext_pmeta123(j) for j in jp2]
 
@@ -1546,18 +1761,19 @@ def extract_demo_jp2(dataset_uuid, source_local=False):
         values_parents = [(luinst[d.uuid, child], luinst[d.uuid, parent]) for d, child, parent in parents]
         return values_parents
 
+    # shared by make_void and make_vocd so objects is only filtered once
+    package_ids = [o for o, b in objects.items() if b['id_type'] == 'package']
+
     def make_void(this_dataset_updated_uuid, i):
         # we don't derive anything from the dataset updated uuid so nothing goes here
-        void = [
-            (o, i.id_nerve_cross_section, i.addr_const_null, None)
-            for o, b in objects.items()
-            if b['id_type'] == 'package'
-        ]
+        id_ncs, addr_const_null = i.id_nerve_cross_section, i.addr_const_null
+        void = [(o, id_ncs, addr_const_null, None) for o in package_ids]
         return void
 
     def make_vocd(this_dataset_updated_uuid, i):
         # we don't derive anything from the dataset updated uuid so nothing goes here
-        vocd = [(o, i.cd_obj, i.addr_const_null) for o, b in objects.items() if b['id_type'] == 'package']
+        cd_obj, addr_const_null = i.cd_obj, i.addr_const_null
+        vocd = [(o, cd_obj, addr_const_null) for o in package_ids]
         return vocd
 
     def make_voqd(this_dataset_updated_uuid, i):
@@ -1566,17 +1782,20 @@ def extract_demo_jp2(dataset_uuid, source_local=False):
 
     def make_values_cat(this_dataset_updated_uuid, i, luinst):
         # we don't derive anything from the dataset updated uuid so nothing goes here
-        values_cv = [
-            (
-                None,
-                i.ct_hack,
-                e['object'].uuid,
-                i.id_nerve_cross_section,
-                i.cd_obj,  # if we mess this up the fk ok obj_desc_cat will catch it :)
-                luinst[e['dataset'].uuid, e['sample']],  # get us the instance
-            )
-            for e in exts
-        ]
+        ct_hack, id_ncs, cd_obj = i.ct_hack, i.id_nerve_cross_section, i.cd_obj
+        # a sample has many jp2 files so resolve each sample instance once
+        sample_inst = {}
+        values_cv = []
+        append = values_cv.append
+        for e in exts:
+            sk = e['dataset'], e['sample']
+            inst = sample_inst.get(sk)
+            if inst is None:
+                inst = sample_inst[sk] = luinst[sk[0].uuid, sk[1]]  # get us the instance
+
+            # if we mess up cd_obj the fk ok obj_desc_cat will catch it :)
+            append((None, ct_hack, e['object'].uuid, id_ncs, cd_obj, inst))
+
         return values_cv
 
     def make_values_quant(this_dataset_updated_uuid, i, luinst):
@@ -1633,17 +1852,27 @@ def extract_demo(dataset_uuid, source_local=True):
     obj_file_id = ap.cache_file_id
 
     m.keys()
-    ks = 'NFasc', 'dFasc_um', 'dNerve_um', 'laterality', 'level', 'sex', 'sub_sam'
     # so insanely dFasc_um and dNerve_um claim dtype('<f8') but store float64 internally ???
-    fks = (
-        (lambda a: int(a[0])),
-        (lambda a: a.tolist()),
-        (lambda a: float(a[0])),
-        (lambda s: str(s)),
-        (lambda s: str(s)),
-        (lambda s: str(s)),
-        (lambda s: str(s)),
-    )
+    # every cell except dFasc_um holds exactly one value, so each column is
+    # pulled out with one concatenate instead of a python call per cell
+    n = len(m['sub_sam'][0])
+    cols = {}
+    for k in ('NFasc', 'dNerve_um', 'level', 'sub_sam'):  # laterality and sex are not used yet
+        col = np.concatenate(m[k][0]).ravel()
+        if len(col) != n:
+            msg = f'{k} has cells that do not hold exactly one value'
+            raise ValueError(msg)
+
+        cols[k] = col
+
+    # only the C prefixed samples are loaded, filter every column up front
+    sub_sams = cols['sub_sam'].astype(str)
+    keep = np.char.startswith(sub_sams, 'C')
+    sub_sams = sub_sams[keep].tolist()
+    nfascs = cols['NFasc'][keep].astype(np.int64).tolist()
+    dnerves = cols['dNerve_um'][keep].astype(np.float64).tolist()
+    levels = cols['level'][keep].astype(str).tolist()
+    dfascs = [v[0].tolist() for v, k in zip(m['dFasc_um'][0], keep) if k]  # ragged, one row of fascicles per nerve
 
     def level_to_vdd(level):
         if level == 'C':  # cervical
@@ -1665,17 +1894,11 @@ def extract_demo(dataset_uuid, source_local=True):
             msg = f'unknown vagus level {level}'
             raise NotImplementedError(msg)
 
-    sane_data = [{k: fk(v[0]) for k, fk, v in zip(ks, fks, _)} for _ in zip(*[m[k][0] for k in ks])]
     instances = {}
     parents = []
     nerve_qvs = []
     fasc_qvs = []
-    for sd in sane_data:
-        ss = sd['sub_sam']
-        ss_prefix = ss[0]
-        if ss_prefix != 'C':
-            continue
-
+    for ss, level, dnerve, nfasc, dfasc in zip(sub_sams, levels, dnerves, nfascs, dfascs):
         subject_n, sample_n = ss[1:].split('-')
         id_sub = f'sub-{subject_n}'
         id_sam = f'sam-sub-{subject_n}_sam-{sample_n}'
@@ -1685,19 +1908,20 @@ def extract_demo(dataset_uuid, source_local=True):
             'id_sub': id_sub,
             'id_sam': id_sam,
         }
-        vdd = level_to_vdd(sd['level'])
+        vdd = level_to_vdd(level)
         nerve_qvs.append(
             {
                 **vdd,
                 'id_formal': id_sam,
                 'desc_inst': 'nerve-cross-section',
-                'diameter-um': sd['dNerve_um'],
-                'number-of-fascicles': sd['NFasc'],
+                'diameter-um': dnerve,
+                'number-of-fascicles': nfasc,
             }
         )
 
-        for i, fdum in enumerate(sd['dFasc_um']):
-            id_formal = f'fasc-{id_sam}-{i}'
+        fasc_prefix = f'fasc-{id_sam}-'
+        for i, fdum in enumerate(dfasc):
+            id_formal = fasc_prefix + str(i)
             parents.append((dataset_id, id_formal, id_sam))
             instances[(dataset_id, id_formal)] = {
                 'type': 'below',
@@ -1746,30 +1970,21 @@ def extract_demo(dataset_uuid, source_local=True):
         values_parents = [(luinst[d.uuid, child], luinst[d.uuid, parent]) for d, child, parent in parents]
         return values_parents
 
+    # shared by make_void and make_vocd so objects is only filtered once
+    package_ids = [o for o, b in objects.items() if b['id_type'] == 'package']
+
     def make_void(this_dataset_updated_uuid, i):
+        addr = i.addr_dFasc_um_idx
         void = [
-            (
-                o,
-                i.id_nerve_cross_section,
-                i.addr_dFasc_um_idx,
-                None,
-            )  # FIXME add_const_null is wrong, should be "from curator"
-            for o, b in objects.items()
-            if b['id_type'] == 'package'
-        ] + [
-            (
-                o,
-                i.id_fascicle_cross_section,
-                i.addr_dFasc_um_idx,
-                None,
-            )  # FIXME add_const_null is wrong, should be "from curator"
-            for o, b in objects.items()
-            if b['id_type'] == 'package'
+            (o, id_cs, addr, None)  # FIXME add_const_null is wrong, should be "from curator"
+            for id_cs in (i.id_nerve_cross_section, i.id_fascicle_cross_section)
+            for o in package_ids
         ]
         return void
 
     def make_vocd(this_dataset_updated_uuid, i):
-        vocd = [(o, i.cd_obj, i.addr_const_null) for o, b in objects.items() if b['id_type'] == 'package']
+        cd_obj, addr_const_null = i.cd_obj, i.addr_const_null
+        vocd = [(o, cd_obj, addr_const_null) for o in package_ids]
         return vocd
 
     def make_voqd(this_dataset_updated_uuid, i):
@@ -1784,63 +1999,51 @@ def extract_demo(dataset_uuid, source_local=True):
         return voqd
 
     def make_values_cat(this_dataset_updated_uuid, i, luinst):
+        ct_hack, cd_obj = i.ct_hack, i.cd_obj
         values_cv = [
             (
                 None,
-                i.ct_hack,
+                ct_hack,
                 obj_uuid,
-                i.id_nerve_cross_section,
-                i.cd_obj,  # if we mess this up the fk ok obj_desc_cat will catch it :)
-                luinst[dataset_uuid, id_formal],  # get us the instance
+                id_cs,
+                cd_obj,  # if we mess this up the fk ok obj_desc_cat will catch it :)
+                luinst[dataset_uuid, e['id_formal']],  # get us the instance
             )
-            for id_formal in [e['id_formal'] for e in nerve_qvs]
-        ] + [
-            (
-                None,
-                i.ct_hack,
-                obj_uuid,
-                i.id_fascicle_cross_section,
-                i.cd_obj,  # if we mess this up the fk ok obj_desc_cat will catch it :)
-                luinst[dataset_uuid, id_formal],  # get us the instance
-            )
-            for id_formal in [e['id_formal'] for e in fasc_qvs]
+            for qvs, id_cs in ((nerve_qvs, i.id_nerve_cross_section), (fasc_qvs, i.id_fascicle_cross_section))
+            for e in qvs
         ]
 
         return values_cv
 
     def make_values_quant(this_dataset_updated_uuid, i, luinst):
-        values_qv = [
-            (
-                e[k],
-                obj_uuid,
-                i.luid[e['desc_inst']],
-                qd,
-                luinst[dataset_uuid, e['id_formal']],
-                e[k],
-            )
-            for e, k, qd in [
-                (e, k, qd)
-                for e in nerve_qvs
-                for k, qd in (
-                    ('number-of-fascicles', i.qd_count),  # FIXME population of thing counts within context
-                    ('diameter-um', i.qd_nerve_cs_diameter_um),
-                    ('vd', i.qd_nvlai1),
-                    ('vd-min', i.qd_nvlain1),
-                    ('vd-max', i.qd_nvlaix1),
-                )
-            ]
-            + [
-                (e, k, qd)
-                for e in fasc_qvs
-                for k, qd in (
-                    ('diameter-um', i.qd_fasc_cs_diameter_um),
-                    ('vd', i.qd_nvlai1),
-                    ('vd-min', i.qd_nvlain1),
-                    ('vd-max', i.qd_nvlaix1),
-                )
-            ]
-            if k in e  # handle vd out for fasc for now
-        ]
+        # field to quant desc maps are built once per call, not once per e
+        nerve_fields = (
+            ('number-of-fascicles', i.qd_count),  # FIXME population of thing counts within context
+            ('diameter-um', i.qd_nerve_cs_diameter_um),
+            ('vd', i.qd_nvlai1),
+            ('vd-min', i.qd_nvlain1),
+            ('vd-max', i.qd_nvlaix1),
+        )
+        fasc_fields = (
+            ('diameter-um', i.qd_fasc_cs_diameter_um),
+            ('vd', i.qd_nvlai1),
+            ('vd-min', i.qd_nvlain1),
+            ('vd-max', i.qd_nvlaix1),
+        )
+        luid = i.luid
+        values_qv = []
+        append = values_qv.append
+        for qvs, fields in ((nerve_qvs, nerve_fields), (fasc_qvs, fasc_fields)):
+            for e in qvs:
+                present = [(k, qd) for k, qd in fields if k in e]  # handle vd out for fasc for now
+                if not present:
+                    continue
+
+                di = luid[e['desc_inst']]
+                inst = luinst[dataset_uuid, e['id_formal']]
+                for k, qd in present:
+                    append((e[k], obj_uuid, di, qd, inst, e[k]))
+
         return values_qv
 
     make_equiv_inst = lambda i, l: []
@@ -1947,12 +2150,12 @@ register_type(AsIs, 'quantity')  # HACK
 def extract_fasc_fib(dataset_uuid, source_local=True):
 
     dataset_id = RemoteId('dataset:' + dataset_uuid)
-    resp_dataset = requests.get(f'https://cassava.ucsd.edu/sparc/datasets/{dataset_uuid}/LATEST/curation-export.json')
-    blob_dataset = resp_dataset.json()
+    resp_dataset = _http.get(f'https://cassava.ucsd.edu/sparc/datasets/{dataset_uuid}/LATEST/curation-export.json')
+    blob_dataset = orjson.loads(resp_dataset.content)
     ir_dataset = fromJson(blob_dataset)
 
-    resp = requests.get(f'https://cassava.ucsd.edu/sparc/datasets/{dataset_uuid}/LATEST/path-metadata.json')
-    blob = resp.json()
+    resp = _http.get(f'https://cassava.ucsd.edu/sparc/datasets/{dataset_uuid}/LATEST/path-metadata.json')
+    blob = orjson.loads(resp.content)
     for j in blob['data']:
         j['type'] = 'pathmeta'
 
@@ -1970,7 +2173,7 @@ def extract_fasc_fib(dataset_uuid, source_local=True):
     # FIXME this is a hacked way to find the files we want, the proper way is to
     # use the metadata sheets
 
-    csvs = [p for p in ir['data'] if 'mimetype' in p and p['mimetype'] == 'text/csv']
+    csvs = [p for p in ir['data'] if p.get('mimetype') == 'text/csv']
     fascs = [p for p in csvs if match_fasc(p)]
     fibs = [p for p in csvs if match_fib(p)]
     other = [p for p in csvs if not match_fasc(p) and not match_fib(p)]
@@ -2404,7 +2607,19 @@ def ingest_fasc_fib(session, source_local=True, do_insert=True, commit=False, de
     ingest(dataset_uuid, extract_fasc_fib, session, commit=commit, dev=dev)
 
 
-def ingest_reva_ft_all(session, source_local=False, do_insert=True, batch=False, commit=False, dev=False):
+def ingest_reva_ft_all(
+    session,
+    source_local=False,
+    do_insert=True,
+    batch=False,
+    commit=False,
+    dev=False,
+    cache=False,
+    rebuild_indexes=False,
+):
+    """rebuild_indexes drops the non unique indexes on the merged tables
+    and recreates them after the batched merge, this locks the tables for
+    the whole load so only use it for full reloads, see drop_indexes"""
 
     dataset_uuids = ('2a3d01c0-39d3-464a-8746-54c9d67ebe0f',)  # f006
     # (
@@ -2416,19 +2631,70 @@ def ingest_reva_ft_all(session, source_local=False, do_insert=True, batch=False,
     #     '04a5fed9-7ba6-4292-b1a6-9cab5c38895f',  # f005
     # )
 
-    batched = []
-    for dataset_uuid in dataset_uuids:
-        if do_insert and not batch:
-            ingest(dataset_uuid, extract_reva_ft, session, source_local=source_local, commit=commit, dev=dev)
-        else:
-            # FIXME make it possible to stage everything and then batch the inserts
-            values_args = extract_reva_ft(dataset_uuid, source_local=source_local)
+    if do_insert and batch:
+        # the batched load commits once at the end so these last for all of it
+        session.execute(sql_text('SET LOCAL synchronous_commit = off'))
+        session.execute(sql_text("SET LOCAL maintenance_work_mem = '512MB'"))
+
+    # staging state is per run so nothing is left over from a failed run
+    stager = Inserts()
+
+    # datasets are independent and extract mostly waits on fetching, so all
+    # extracts start at once and each dataset is inserted as soon as its
+    # extract is done while the rest are still running, inserts stay serial
+    with ThreadPoolExecutor(max_workers=len(dataset_uuids)) as pool:
+        futures = [
+            pool.submit(extract_reva_ft, dataset_uuid, source_local=source_local, cache=cache)
+            for dataset_uuid in dataset_uuids
+        ]
+        if do_insert:
+            # warm the InternalIds lookups while the extracts are still fetching
+            Queries(session).prefetch()
+
+        for dataset_uuid in dataset_uuids:
+            # pop so that each dataset's extract can be freed once it is
+            # inserted instead of every dataset staying alive until the end
+            values_args = futures.pop(0).result()
+            if not do_insert:
+                continue
+
             if batch:
-                batched.append((dataset_uuid, values_args))
+                # all batched datasets go in as a single transaction, the rows that
+                # depend on instances are staged and merged once for all datasets
+                ingest(
+                    dataset_uuid,
+                    None,
+                    session,
+                    commit=False,
+                    dev=dev,
+                    values_args=values_args,
+                    use_copy=True,
+                    stage=True,
+                    inserts=stager,
+                )
+            else:
+                # 1000 lines up with insertmanyvalues_page_size on the engine in main
+                ingest(
+                    dataset_uuid,
+                    None,
+                    session,
+                    commit=commit,
+                    dev=dev,
+                    values_args=values_args,
+                    chunk_size=1000,
+                )
 
     if do_insert and batch:
-        for duuid, vargs in batched:
-            ingest(duuid, None, session, commit=commit, dev=dev, values_args=vargs)
+        # full reloads can drop the secondary indexes on the merged tables and
+        # rebuild them once after the merge, it is all one transaction so
+        # the indexes come back if anything fails
+        index_defs = drop_indexes(session, stager.staged) if rebuild_indexes else []
+        stager.merge(session, dev=dev)
+        for index_def in index_defs:
+            session.execute(sql_text(index_def))
+
+        if commit:
+            session.commit()
 
 
 def ingest_entity_metadata_all(session, source_local=False, do_insert=True, batch=False, commit=False, dev=False):
@@ -2446,8 +2712,8 @@ def ingest_entity_metadata_all(session, source_local=False, do_insert=True, batc
                 blob = json.load(f)
         else:
             url = 'https://cassava.ucsd.edu/sparc/preview/archive/summary/LATEST/curation-export.json'
-            resp = requests.get(url)
-            blob = resp.json()
+            resp = _http.get(url)
+            blob = orjson.loads(resp.content)
 
         ir = fromJson(blob)
 
@@ -2456,7 +2722,7 @@ def ingest_entity_metadata_all(session, source_local=False, do_insert=True, batc
         _dblobs = []
         for _uuid in _uuids:
             url = f'https://cassava.ucsd.edu/sparc/preview/archive/summary/LATEST/snapshot/{_uuid}/curation-export.json'
-            _dblobs.append(requests.get(url).json())
+            _dblobs.append(orjson.loads(_http.get(url).content))
 
     dblobs = [
         d
@@ -2505,7 +2771,7 @@ def ingest_entity_metadata_all(session, source_local=False, do_insert=True, batc
                 f'https://cassava.ucsd.edu/sparc/preview/archive/summary/LATEST/snapshot/{did.uuid}/path-metadata.json'
             )
             resp = rsession.get(url)
-            j = resp.json()
+            j = orjson.loads(resp.content)
             updated_transitive = ''
             for i, pb in enumerate(j['data']):
                 if i > 0 and pb['timestamp_updated'] > updated_transitive:
@@ -2783,12 +3049,38 @@ def ingest_entity_metadata_all(session, source_local=False, do_insert=True, batc
         ingest(did.uuid, extract_entities, session, source_local=source_local, commit=commit, dev=dev)
 
 
-def main(source_local=False, commit=False, echo=False):
+@lru_cache
+def get_engine(dbuser, host, port, database):
+    # one engine per database so repeated main calls reuse it
+    return create_engine(
+        dbUri(dbuser, host, port, database),
+        # the insert statements are fixed now (see Inserts) so the compiled cache pays off
+        query_cache_size=1200,
+        # inserts go through insertmanyvalues, non insert executemany (if any) through execute_batch
+        executemany_mode='values_plus_batch',
+        insertmanyvalues_page_size=1000,
+        executemany_batch_page_size=500,
+        pool_size=8,
+        max_overflow=4,
+        pool_pre_ping=True,
+        pool_recycle=3600,
+    )
+
+
+def main(source_local=False, commit=False, echo=False, verbose=False, batch=True, rebuild_indexes=False):
+    """both echo and verbose are off by default since statement logging
+    formats parameters for every execute, verbose routes it through the
+    sqlalchemy.engine logger instead of echo adding its own stdout handler
+    batch stages the reva ft rows from all datasets and merges them once
+    rebuild_indexes is for full reloads only, see drop_indexes"""
     from quantdb.config import auth
 
+    if verbose:
+        logging.getLogger('sqlalchemy.engine').setLevel(logging.INFO)
+
     dbkwargs = {k: auth.get(f'db-{k}') for k in ('user', 'host', 'port', 'database')}  # TODO integrate with cli options
     dbkwargs['dbuser'] = dbkwargs.pop('user')
-    engine = create_engine(dbUri(**dbkwargs), query_cache_size=0)
+    engine = get_engine(**dbkwargs)
     log.info(engine)
     engine.echo = echo
     session = Session(engine)
@@ -2800,55 +3092,70 @@ def main(source_local=False, commit=False, echo=False):
     do_demo_jp2 = False or do_all
     do_demo = False or do_all
 
-    if do_ent_all:
-        try:
+    try:
+        if do_ent_all:
             ingest_entity_metadata_all(session, source_local=source_local, do_insert=True, commit=commit, dev=True)
-        except Exception as e:
-            session.rollback()
-            session.close()
-            engine.dispose()
-            raise e
-
-    if do_fasc_fib:
-        try:
+
+        if do_fasc_fib:
             ingest_fasc_fib(session, source_local=source_local, do_insert=True, commit=commit, dev=True)
-        except Exception as e:
-            session.rollback()
-            session.close()
-            engine.dispose()
-            raise e
-
-    if do_reva_ft:
-        try:
-            ingest_reva_ft_all(session, source_local=source_local, do_insert=True, batch=True, commit=commit, dev=True)
-        except Exception as e:
-            session.rollback()
-            session.close()
-            engine.dispose()
-            raise e
-
-    if do_demo_jp2:
-        try:
+
+        if do_reva_ft:
+            ingest_reva_ft_all(
+                session,
+                source_local=source_local,
+                do_insert=True,
+                batch=batch,
+                commit=commit,
+                dev=True,
+                cache=True,
+                rebuild_indexes=rebuild_indexes,
+            )
+
+        if do_demo_jp2:
             ingest_demo_jp2(session, source_local=source_local, do_insert=True, commit=commit, dev=True)
-        except Exception as e:
-            session.rollback()
-            session.close()
-            engine.dispose()
-            raise e
-
-    if do_demo:
-        try:
+
+        if do_demo:
             ingest_demo(session, source_local=source_local, do_insert=True, commit=commit, dev=True)
-        except Exception as e:
-            session.rollback()
-            session.close()
-            engine.dispose()
-            raise e
-
-    session.close()
-    engine.dispose()
+    except Exception as e:
+        session.rollback()
+        raise e
+    finally:
+        session.close()
+        engine.dispose()
+
     log.info('ingest done')
 
 
 if __name__ == '__main__':
-    main()
+    import argparse
+
+    parser = argparse.ArgumentParser(description='Ingest all known datasets into quantdb')
+    parser.add_argument('--source-local', action='store_true', help='Read sparcur exports from disk')
+    parser.add_argument('--commit', action='store_true', help='Commit the ingest')
+    parser.add_argument('--verbose', action='store_true', help='Log sql statements via the sqlalchemy.engine logger')
+    parser.add_argument('--echo', action='store_true', help='Echo sql statements to stdout')
+    parser.add_argument('--dry-run', action='store_true', help='Print the generated insert sql for each table and exit')
+    parser.add_argument(
+        '--batch-across-datasets',
+        action=argparse.BooleanOptionalAction,
+        default=True,
+        help='COPY the reva ft datasets into staging and merge each table once for all of them',
+    )
+    parser.add_argument(
+        '--rebuild-indexes',
+        action='store_true',
+        help='Full reloads only, drop and rebuild secondary indexes around the batched merge (locks the tables)',
+    )
+    args = parser.parse_args()
+    if args.dry_run:
+        for name, sql in inserts.render(dev=True).items():
+            print(f'-- {name}\n{sql};')
+    else:
+        main(
+            source_local=args.source_local,
+            commit=args.commit,
+            echo=args.echo,
+            verbose=args.verbose,
+            batch=args.batch_across_datasets,
+            rebuild_indexes=args.rebuild_indexes,
+        )
@@ -4,19 +4,27 @@ Test suite for specific ingest extract functions.
 Tests the actual extract_reva_ft and other extract functions from quantdb/ingest.py
 """
 
+import io
+import json
 from datetime import datetime
 from unittest.mock import Mock, patch
 
 import numpy as np
 import pytest
 from sparcur.utils import PennsieveId as RemoteId
-from sqlalchemy import text
+from sqlalchemy import Integer, text
+from sqlalchemy.orm import Session
 
 from quantdb.ingest import (
+    Queries,
+    copy_rows,
     extract_demo,
     extract_demo_jp2,
     extract_reva_ft,
+    getName,
     ingest,
+    makeParamsValues,
+    scan_path_metadata,
 )
 
 
@@ -35,18 +43,17 @@ class TestExtractFunctions:
         test_object_uuid = '1ff97dbc-05e0-4c53-8c92-31a7b9bf75ab'
 
         # Mock the external dependencies to avoid actual API calls
-        with patch('quantdb.ingest.requests.get') as mock_get:
+        with patch('quantdb.ingest._http.get') as mock_get:
             # Mock the response from the API
             mock_response = Mock()
             mock_response.json.return_value = {
                 'data': [
-                    {'basename': 'test-dataset-f001', 'timestamp_updated': test_timestamp},
+                    {'basename': 'test-dataset-f001', 'timestamp_updated': test_timestamp.isoformat()},
                     {
-                        'type': 'pathmeta',
-                        'timestamp_updated': test_timestamp,
+                        'timestamp_updated': test_timestamp.isoformat(),
                         'mimetype': 'image/jpx',
-                        'dataset': {'uuid': dataset_uuid, 'type': 'dataset'},
-                        'object': {'uuid': test_object_uuid, 'type': 'package'},
+                        'dataset_id': f'N:dataset:{dataset_uuid}',
+                        'remote_id': f'N:package:{test_object_uuid}',
                         'file_id': 12345,  # Use integer for file_id
                         'subject': 'sub-001',
                         'sample': 'sam-001',
@@ -56,6 +63,8 @@ class TestExtractFunctions:
                     },
                 ]
             }
+            mock_response.content = json.dumps(mock_response.json.return_value).encode()
+            mock_response.raw = io.BytesIO(mock_response.content)
             mock_get.return_value = mock_response
 
             # Mock fromJson to avoid the breakpoint
@@ -125,7 +134,7 @@ class TestExtractFunctions:
         """Test extract_reva_ft error handling."""
         dataset_uuid = 'invalid-uuid'
 
-        with patch('quantdb.ingest.requests.get') as mock_get:
+        with patch('quantdb.ingest._http.get') as mock_get:
             # Simulate an error
             mock_get.side_effect = Exception('Dataset not found')
 
@@ -155,15 +164,17 @@ class TestExtractFunctions:
         """Smoke test for various extract functions to ensure they don't crash."""
         # Mock based on which extract function we're testing
         if extract_func == extract_reva_ft:
-            with patch('quantdb.ingest.requests.get') as mock_get:
+            with patch('quantdb.ingest._http.get') as mock_get:
                 mock_response = Mock()
                 test_timestamp = datetime(2024, 1, 1, 0, 0, 1)
                 mock_response.json.return_value = {
                     'data': [
-                        {'timestamp_updated': test_timestamp},
-                        {'timestamp_updated': test_timestamp, 'mimetype': 'image/jpx'},
+                        {'timestamp_updated': test_timestamp.isoformat()},
+                        {'timestamp_updated': test_timestamp.isoformat(), 'mimetype': 'image/jpx'},
                     ]
                 }
+                mock_response.content = json.dumps(mock_response.json.return_value).encode()
+                mock_response.raw = io.BytesIO(mock_response.content)
                 mock_get.return_value = mock_response
 
                 with patch('quantdb.ingest.fromJson') as mock_fromJson:
@@ -207,15 +218,17 @@ class TestExtractFunctions:
                             assert True
 
         elif extract_func == extract_demo_jp2:
-            with patch('quantdb.ingest.requests.get') as mock_get:
+            with patch('quantdb.ingest._http.get') as mock_get:
                 mock_response = Mock()
                 test_timestamp = datetime(2024, 1, 1, 0, 0, 1)
                 mock_response.json.return_value = {
                     'data': [
-                        {'timestamp_updated': test_timestamp},
-                        {'timestamp_updated': test_timestamp, 'mimetype': 'image/jp2'},
+                        {'timestamp_updated': test_timestamp.isoformat()},
+                        {'timestamp_updated': test_timestamp.isoformat(), 'mimetype': 'image/jp2'},
                     ]
                 }
+                mock_response.content = json.dumps(mock_response.json.return_value).encode()
+                mock_response.raw = io.BytesIO(mock_response.content)
                 mock_get.return_value = mock_response
 
                 with patch('quantdb.ingest.fromJson') as mock_fromJson:
@@ -261,3 +274,68 @@ class TestIngestIntegration:
         # Session should still be usable after rollback
         result = test_session.execute(text('SELECT 1')).scalar()
         assert result == 1
+
+
+class TestIngestHelpers:
+    """Tests for the pure helper functions used by ingest."""
+
+    def test_getname_dedupes_containers(self):
+        """Equal containers share a name, distinct containers do not."""
+        getname = getName()
+        blob = {'a': [1, 2], 'b': {'c': 3}}
+        name = getname(blob)
+        assert getname(blob) == name
+        assert getname({'a': [1, 2], 'b': {'c': 3}}) == name
+        assert getname({'a': [1, 2], 'b': {'c': 4}}) != name
+        assert getname(1) == getname(1)
+        assert getname(True) != getname(1)
+
+    def test_make_params_values_row_types_bind_once(self):
+        """A repeated typed value only gets one bindparam."""
+        vt, params, bindparams = makeParamsValues([(1,), (1,)], row_types=(Integer,))
+        assert vt == '(:v0), (:v0)'
+        assert params == {'v0': 1}
+        assert [b.key for b in bindparams] == ['v0']
+
+    def test_scan_path_metadata_compares_parsed_timestamps(self):
+        """Fractions written with a comma still sort after the whole second."""
+        records = [
+            {'basename': 'dataset'},
+            {'timestamp_updated': '2024-01-01T00:00:01,5Z', 'mimetype': 'image/jpx'},
+            {'timestamp_updated': '2024-01-01T00:00:01Z', 'mimetype': 'text/csv'},
+        ]
+        first, updated_transitive, keep = scan_path_metadata(iter(records))
+        assert first == {'basename': 'dataset'}
+        assert updated_transitive.isoformat() == '2024-01-01T00:00:01.500000+00:00'
+        assert keep == [records[1]]
+
+    def test_queries_cache_cleared_on_rollback(self):
+        """Ids cached during a transaction do not outlive its rollback."""
+        session = Session()
+        q = Queries(session)
+        q._cache['prefetched'] = True
+        session.begin()
+        session.commit()
+        assert Queries(session)._cache == {'prefetched': True}
+        session.begin()
+        session.rollback()
+        assert Queries(session)._cache == {}
+        assert Queries(Session())._cache == {}
+
+    def test_copy_rows_stages_on_conflict(self):
+        """COPY goes through a staging table when conflicts must be skipped."""
+        session = Mock()
+        cursor = session.connection.return_value.connection.cursor.return_value
+        copied = []
+        cursor.copy_expert.side_effect = lambda sql, buf: copied.append((sql, buf.read()))
+
+        copy_rows(
+            session, 'values_cat', ('value_open', 'object'), [('', 'a'), (None, 'b')], on_conflict_do_nothing=True
+        )
+
+        ((sql, data),) = copied
+        assert sql.startswith('COPY copy_stage_values_cat (value_open, object) FROM STDIN')
+        assert data.splitlines() == [',a', '\\N,b']
+        assert 'ON CONFLICT DO NOTHING' in cursor.execute.call_args_list[-2].args[0]
+        assert cursor.execute.call_args_list[-1].args[0] == 'DROP TABLE copy_stage_values_cat'
+        cursor.close.assert_called_once()